@@ -1,8 +1,15 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
-from models import db, User, Product, Cart, CartItem, Feedback, Order, OrderItem, Category
+import os
+import click
+from models import db, User, Product, Cart, CartItem, Feedback, Order, OrderItem, Category, upgrade_schema
+from images import image_store
+from inventory import OutOfStock, parse_stock, set_stock, adjust_stock, available_stock, stock_levels, consume, release_cart, forget_product, start_sweeper, sweep_expired_reservations
+from retention import run_retention, start_retention_job, orders_for_user, all_orders
+from autocomplete import search_index, DEFAULT_LIMIT, TOP_N
+from carts import CartError, parse_ops, apply_user_ops, apply_guest_ops, guest_cart, merge_guest_cart, cart_summary
 
 # Initialize Flask application
 app = Flask(__name__)
@@ -11,11 +18,18 @@ app.config['SECRET_KEY'] = 'your_secret_key_here'  # Để sử dụng flash mes
 # Configure SQLAlchemy
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 15}}  # Chờ khóa SQLite khi nhiều người cùng mua
 db.init_app(app)  # Khởi tạo SQLAlchemy với app
 
+# Lưu ảnh sản phẩm trên ổ đĩa local
+app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024
+image_store.init_app(app)
+
 # Define models (already defined in your case)
 with app.app_context():
     db.create_all()
+    upgrade_schema()
+    search_index.build()  # Index gợi ý tìm kiếm nằm trong bộ nhớ
     
     # Kiểm tra và tạo tài khoản admin nếu chưa tồn tại
     if not User.query.filter_by(username='admin').first():
@@ -81,6 +95,11 @@ def login():
 
         if user and user.check_password(password):
             session['user_id'] = user.id  # Lưu user_id vào session
+            adjusted = merge_guest_cart(session, user)  # Gộp giỏ hàng lúc chưa đăng nhập
+            if adjusted:
+                details = ', '.join(f'{name} (còn {quantity}/{requested})' if quantity else f'{name} (hết hàng)'
+                                    for name, requested, quantity in adjusted)
+                flash(f'Một số sản phẩm trong giỏ hàng không còn đủ hàng: {details}.', 'info')
             if user.is_admin:
                 return redirect(url_for('admin_products'))
             else:
@@ -135,7 +154,8 @@ def admin_products():
         return redirect(url_for('index'))
 
     products = Product.query.all()
-    return render_template('admin_products.html', products=products)
+    stocks = stock_levels([product.id for product in products])
+    return render_template('admin_products.html', products=products, stocks=stocks)
 
 
 @app.route('/admin/products/add', methods=['GET', 'POST'])
@@ -157,6 +177,20 @@ def admin_add_product():
         author = request.form.get('author')  # Nhận tác giả từ form
         category_id = request.form.get('category')  # Nhận danh mục từ form
 
+        # Để trống số lượng tồn kho thì sản phẩm được bán không giới hạn
+        try:
+            stock = parse_stock(request.form.get('stock'))
+        except ValueError:
+            flash('Số lượng tồn kho phải là số nguyên không âm.', 'danger')
+            return redirect(url_for('admin_add_product'))
+
+        # Nếu admin tải ảnh lên thì ưu tiên ảnh đó thay cho Image URL
+        try:
+            image_url = image_store.save_upload(request.files.get('image')) or image_url
+        except ValueError:
+            flash('Định dạng ảnh không được hỗ trợ.', 'danger')
+            return redirect(url_for('admin_add_product'))
+
         new_product = Product(
             name=name,
             description=description,
@@ -166,7 +200,12 @@ def admin_add_product():
             category_id=category_id  # Lưu category_id
         )
         db.session.add(new_product)
+        db.session.flush()  # Cần id sản phẩm để tạo tồn kho
+
+        if stock is not None:
+            set_stock(new_product.id, stock)
         db.session.commit()
+        search_index.add(new_product)
         flash('Sản phẩm mới đã được thêm.', 'success')
         return redirect(url_for('admin_products'))
 
@@ -192,18 +231,44 @@ def admin_edit_product(product_id):
     categories = Category.query.all()
 
     if request.method == 'POST':
+        # stock_original là số tồn kho lúc form được mở; chỉ thay đổi kho khi admin sửa ô này
+        try:
+            stock = parse_stock(request.form.get('stock'))
+            stock_original = parse_stock(request.form.get('stock_original'))
+        except ValueError:
+            flash('Số lượng tồn kho phải là số nguyên không âm.', 'danger')
+            return redirect(url_for('admin_edit_product', product_id=product.id))
+
+        try:
+            uploaded_url = image_store.save_upload(request.files.get('image'))
+        except ValueError:
+            flash('Định dạng ảnh không được hỗ trợ.', 'danger')
+            return redirect(url_for('admin_edit_product', product_id=product.id))
+
         product.name = request.form.get('name')
         product.description = request.form.get('description')
         product.price = request.form.get('price')
-        product.image_url = request.form.get('image_url')
+        product.image_url = uploaded_url or request.form.get('image_url')
         product.author = request.form.get('author')
         product.category_id = request.form['category']  # Sửa tên trường thành 'category'
 
+        try:
+            if stock != stock_original:
+                if stock is None or stock_original is None:
+                    set_stock(product.id, stock)  # Bật/tắt quản lý tồn kho
+                else:
+                    adjust_stock(product.id, stock - stock_original)
+        except OutOfStock:
+            db.session.rollback()
+            flash('Tồn kho hiện tại không đủ để giảm theo số lượng này.', 'danger')
+            return redirect(url_for('admin_edit_product', product_id=product.id))
+
         db.session.commit()
+        search_index.add(product)
         flash('Sản phẩm đã được cập nhật.', 'success')
         return redirect(url_for('admin_products'))
 
-    return render_template('admin_edit_product.html', product=product, categories=categories)
+    return render_template('admin_edit_product.html', product=product, categories=categories, stock=available_stock(product.id))
 
 @app.route('/admin/products/delete/<int:product_id>', methods=['POST'])
 def admin_delete_product(product_id):
@@ -217,8 +282,10 @@ def admin_delete_product(product_id):
         return redirect(url_for('index'))
 
     product = Product.query.get_or_404(product_id)
+    forget_product(product.id)
     db.session.delete(product)
     db.session.commit()
+    search_index.remove(product_id)
     flash('Sản phẩm đã bị xóa.', 'success')
     return redirect(url_for('admin_products'))
 
@@ -334,6 +401,7 @@ def admin_delete_user(user_id):
     # Xử lý việc xóa các cart liên quan
     carts_to_delete = Cart.query.filter_by(user_id=user_to_delete.id).all()
     for cart in carts_to_delete:
+        release_cart(cart.id)  # Trả lại hàng đang giữ
         db.session.delete(cart)
 
     # Xử lý việc xóa các phản hồi liên quan
@@ -359,13 +427,15 @@ def profile():
         return redirect(url_for('index'))
 
 
-    orders = Order.query.filter_by(user_id = user.id).all()
-    return render_template('profile.html', user=user, orders=orders)
+    # Đơn hàng cũ đã được lưu trữ chỉ tải khi người dùng yêu cầu
+    show_archived = request.args.get('archived') == '1'
+    orders = orders_for_user(user.id, include_archived=show_archived)
+    return render_template('profile.html', user=user, orders=orders, show_archived=show_archived)
 
 @app.route('/product/<int:product_id>')
 def product_detail(product_id):
     product = Product.query.get_or_404(product_id)
-    return render_template('product_detail.html', product=product)
+    return render_template('product_detail.html', product=product, stock=available_stock(product.id))
 
 @app.route('/buy/<int:product_id>', methods=['POST'])
 def buy_product(product_id):
@@ -383,23 +453,18 @@ def buy_product(product_id):
     # Lấy giỏ hàng hiện tại của người dùng
     cart = Cart.query.filter_by(user_id=user.id).first()
 
-    # Kiểm tra xem có giỏ hàng hay không
+    # Lấy CartItem của sản phẩm từ giỏ hàng, nếu không có thì mặc định số lượng là 1
+    cart_item = None
     if cart:
-        # Lấy CartItem của sản phẩm từ giỏ hàng
         cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product.id).first()
-        if cart_item:
-            quantity = cart_item.quantity
-        else:
-            quantity = 1  # Nếu không có trong giỏ hàng, mặc định là 1
-    else:
-        quantity = 1  # Nếu không có giỏ hàng, mặc định là 1
+    quantity = cart_item.quantity if cart_item else 1
 
     total_price = product.price * quantity
 
     # Kiểm tra xem người dùng có đủ tiền để mua không
     if user.balance < total_price:
         flash('Bạn không đủ tiền để thực hiện giao dịch này.', 'danger')
-        return redirect(url_for('cart'))
+        return redirect(url_for('view_cart'))
 
     # Tạo đơn hàng mới
     new_order = Order(user_id=user.id, total_price=total_price)
@@ -407,20 +472,21 @@ def buy_product(product_id):
     new_order.items.append(order_item)
 
     try:
-        # Giảm số tiền của người dùng
+        # Trừ kho, trừ tiền, tạo đơn và xóa khỏi giỏ hàng trong cùng một transaction
+        consume(cart.id if cart else None, product.id, quantity)
         user.balance -= total_price
-        db.session.commit()  # Cập nhật số dư của người dùng
-
         db.session.add(new_order)
-        db.session.commit()
-
-        # Nếu sản phẩm có trong giỏ hàng, xóa khỏi giỏ hàng
         if cart_item:
             db.session.delete(cart_item)
-            db.session.commit()
+        db.session.commit()
+        search_index.record_sale(product_id, quantity)
 
         flash('Đã đặt hàng thành công!', 'success')
         return redirect(url_for('index'))
+    except OutOfStock:
+        db.session.rollback()
+        flash('Sản phẩm đã hết hàng.', 'danger')
+        return redirect(url_for('product_detail', product_id=product_id))
     except Exception as e:
         db.session.rollback()
         flash('Đã xảy ra lỗi khi đặt hàng. Vui lòng thử lại sau.', 'danger')
@@ -434,9 +500,10 @@ def admin_orders():
         flash('Bạn cần đăng nhập với tài khoản admin để truy cập.', 'danger')
         return redirect(url_for('login'))
 
-    orders = Order.query.all()  # Thay thế bằng câu truy vấn thực tế để lấy danh sách đơn hàng
+    show_archived = request.args.get('archived') == '1'
+    orders = all_orders(include_archived=show_archived)
 
-    return render_template('admin_orders.html', orders=orders)
+    return render_template('admin_orders.html', orders=orders, show_archived=show_archived)
 
 @app.route('/admin/orders/approve/<int:order_id>', methods=['POST'])
 def approve_order(order_id):
@@ -477,8 +544,8 @@ def reject_order(order_id):
 @app.route('/cart')
 def view_cart():
     if 'user_id' not in session:
-        flash('Bạn cần đăng nhập để truy cập trang này.', 'danger')
-        return redirect(url_for('login'))
+        # Khách chưa đăng nhập dùng giỏ hàng lưu trong session
+        return render_template('cart.html', cart=guest_cart(session))
 
     user = User.query.get(session['user_id'])
     if not user:
@@ -496,34 +563,57 @@ def view_cart():
 
 @app.route('/add_to_cart/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
-    if 'user_id' not in session:
-        flash('Bạn cần đăng nhập để truy cập trang này.', 'danger')
-        return redirect(url_for('login'))
-
-    user = User.query.get(session['user_id'])
-    if not user:
-        flash('Người dùng không tồn tại.', 'danger')
+    ops = [('add', product_id, 1)]
+    try:
+        if 'user_id' in session:
+            user = User.query.get(session['user_id'])
+            if not user:
+                flash('Người dùng không tồn tại.', 'danger')
+                return redirect(url_for('index'))
+            apply_user_ops(user, ops)
+        else:
+            apply_guest_ops(session, ops)
+    except CartError as e:
+        db.session.rollback()
+        flash(str(e), 'danger')
         return redirect(url_for('index'))
 
-    product = Product.query.get_or_404(product_id)
-
-    # Lấy giỏ hàng hiện tại của người dùng
-    cart = Cart.query.filter_by(user_id=user.id).first()
-    if not cart:
-        cart = Cart(user_id=user.id)
-        db.session.add(cart)
-        db.session.commit()
+    flash('Sản phẩm đã được thêm vào giỏ hàng.', 'success')
+    return redirect(url_for('view_cart'))
 
-    # Kiểm tra xem sản phẩm đã có trong giỏ hàng chưa
-    cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product.id).first()
-    if cart_item:
-        cart_item.quantity += 1
+@app.route('/cart/batch', methods=['POST'])
+def cart_batch():
+    # Nhận nhiều thao tác add/update/remove trong một request:
+    # JSON {"ops": [{"op": "update", "product_id": 1, "quantity": 2}, ...]}
+    # hoặc form của cart.html (quantity-<product_id>, remove=<product_id>)
+    data = request.get_json(silent=True)
+    if data is not None:
+        raw_ops = data.get('ops') if isinstance(data, dict) else data
     else:
-        cart_item = CartItem(cart_id=cart.id, product_id=product.id)
-        db.session.add(cart_item)
+        raw_ops = [dict(op='update', product_id=key[len('quantity-'):], quantity=value)
+                   for key, value in request.form.items() if key.startswith('quantity-')]
+        raw_ops += [dict(op='remove', product_id=pid) for pid in request.form.getlist('remove')]
 
-    db.session.commit()
-    flash('Sản phẩm đã được thêm vào giỏ hàng.', 'success')
+    try:
+        ops = parse_ops(raw_ops)
+        if 'user_id' in session:
+            user = User.query.get(session['user_id'])
+            if not user:
+                raise CartError('Người dùng không tồn tại.')
+            items = apply_user_ops(user, ops).items
+        else:
+            apply_guest_ops(session, ops)
+            items = guest_cart(session).items
+    except CartError as e:
+        db.session.rollback()
+        if data is not None:
+            return jsonify(error=str(e)), 400
+        flash(str(e), 'danger')
+        return redirect(url_for('view_cart'))
+
+    if data is not None:
+        return jsonify(cart_summary(items))
+    flash('Giỏ hàng của bạn đã được cập nhật.', 'success')
     return redirect(url_for('view_cart'))
 
 @app.route('/remove_from_cart/<int:item_id>', methods=['POST'])
@@ -538,8 +628,7 @@ def remove_from_cart(item_id):
         return redirect(url_for('index'))
 
     cart_item = CartItem.query.get_or_404(item_id)
-    db.session.delete(cart_item)
-    db.session.commit()
+    apply_user_ops(user, [('remove', cart_item.product_id, 0)])  # Trả lại hàng đang giữ
     flash('Sản phẩm đã được xóa khỏi giỏ hàng.', 'success')
     return redirect(url_for('view_cart'))
 
@@ -573,8 +662,12 @@ def update_cart(item_id):
         flash('Số lượng không thể lớn hơn 100.000.', 'danger')
         return redirect(url_for('view_cart'))
 
-    cart_item.quantity = quantity
-    db.session.commit()
+    try:
+        apply_user_ops(user, [('update', cart_item.product_id, quantity)])
+    except CartError as e:
+        db.session.rollback()
+        flash(str(e), 'danger')
+        return redirect(url_for('view_cart'))
 
     flash('Giỏ hàng của bạn đã được cập nhật.', 'success')
     return redirect(url_for('view_cart'))
@@ -590,6 +683,12 @@ def search():
         products = []
     return render_template('search_results.html', products=products, query=query)
 
+@app.route('/autocomplete')
+def autocomplete():
+    # Gợi ý tìm kiếm từ index trong bộ nhớ, không truy vấn database
+    limit = max(1, min(request.args.get('limit', DEFAULT_LIMIT, type=int), TOP_N))
+    return jsonify(search_index.suggest(request.args.get('q', ''), limit))
+
 @app.route('/feedback', methods=['GET', 'POST'])
 def feedback():
     if 'user_id' not in session:
@@ -673,10 +772,101 @@ def admin_delete_feedback(feedback_id):
 
 @app.route('/checkout', methods=['POST'])
 def checkout():
-    # Logic xử lý thanh toán
-    return redirect(url_for('some_view'))
+    # Thanh toán toàn bộ giỏ hàng thành một đơn hàng
+    if 'user_id' not in session:
+        flash('Bạn cần đăng nhập để thực hiện mua hàng.', 'danger')
+        return redirect(url_for('login'))
+
+    user = User.query.get(session['user_id'])
+    cart = Cart.query.filter_by(user_id=user.id).first()
+    if not cart or not cart.items:
+        flash('Giỏ hàng của bạn đang trống.', 'info')
+        return redirect(url_for('view_cart'))
+
+    items = list(cart.items)
+    total_price = sum(item.product.price * item.quantity for item in items)
+    if user.balance < total_price:
+        flash('Bạn không đủ tiền để thực hiện giao dịch này.', 'danger')
+        return redirect(url_for('view_cart'))
+
+    new_order = Order(user_id=user.id, total_price=total_price)
+    for item in items:
+        new_order.items.append(OrderItem(product_id=item.product_id, quantity=item.quantity, unit_price=item.product.price))
+
+    try:
+        for item in items:
+            consume(cart.id, item.product_id, item.quantity)
+        user.balance -= total_price
+        db.session.add(new_order)
+        sold = [(item.product_id, item.quantity) for item in items]
+        for item in items:
+            db.session.delete(item)
+        db.session.commit()
+        for product_id, quantity in sold:
+            search_index.record_sale(product_id, quantity)
+
+        flash('Đã đặt hàng thành công!', 'success')
+        return redirect(url_for('profile'))
+    except OutOfStock:
+        db.session.rollback()
+        flash('Một số sản phẩm trong giỏ hàng đã hết hàng.', 'danger')
+        return redirect(url_for('view_cart'))
+    except Exception as e:
+        db.session.rollback()
+        flash('Đã xảy ra lỗi khi đặt hàng. Vui lòng thử lại sau.', 'danger')
+        app.logger.error(f"Error while placing order: {str(e)}")
+        return redirect(url_for('view_cart'))
+
+@app.cli.command('sweep-reservations')
+def sweep_reservations():
+    # Trả lại kho các lượt giữ hàng đã hết hạn (dùng cho cron nếu không chạy sweeper nền)
+    total = 0
+    while True:
+        swept = sweep_expired_reservations()
+        total += swept
+        if swept == 0:
+            break
+    click.echo(f'Đã trả lại {total} lượt giữ hàng hết hạn.')
+
+@app.cli.command('import-images')
+@click.option('--source', default=None, help='Thư mục chứa ảnh cũ (tìm theo tên file).')
+def import_images(source):
+    # Chuyển các ảnh local cũ (vd. /static/...) vào kho ảnh và cập nhật image_url
+    imported = 0
+    for product in Product.query.all():
+        url = product.image_url
+        if not url or image_store.is_local(url) or url.startswith(('http://', 'https://', '//')):
+            continue
+
+        path = os.path.join(app.root_path, url.lstrip('/'))
+        if not os.path.isfile(path) and source:
+            path = os.path.join(source, os.path.basename(url))
+        if not os.path.isfile(path) or not image_store.allowed_file(path):
+            click.echo(f'Bỏ qua sản phẩm {product.id}: không tìm thấy ảnh {url}')
+            continue
+
+        try:
+            product.image_url = image_store.import_file(path)
+        except ValueError:
+            click.echo(f'Bỏ qua sản phẩm {product.id}: {url} không phải ảnh hợp lệ')
+            continue
+        imported += 1
+
+    db.session.commit()
+    image_store.executor.shutdown(wait=True)  # Đợi tạo xong thumbnail trước khi thoát
+    click.echo(f'Đã nhập {imported} ảnh.')
+
+@app.cli.command('run-retention')
+def run_retention_command():
+    # Lưu trữ đơn hàng cũ, xóa giỏ hàng bỏ quên và thu gọn database
+    archived, purged = run_retention(app)
+    click.echo(f'Đã lưu trữ {archived} đơn hàng, xóa {purged} giỏ hàng bỏ quên.')
 
 if __name__ == '__main__':
     with app.app_context():
         add_default_categories()
+    # Với debug reloader, chỉ chạy sweeper trong process phục vụ request
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_sweeper(app)
+        start_retention_job(app)
     app.run(host='0.0.0.0', port=1234, debug=True)
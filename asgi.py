@@ -0,0 +1,154 @@
+# Chế độ phục vụ ASGI (tùy chọn): các trang đọc catalog (index, search, chi tiết sản phẩm,
+# lọc theo danh mục) chạy bằng view async trên SQLAlchemy async engine (aiosqlite).
+# Mọi route khác (đăng nhập, giỏ hàng, mua hàng, admin...) vẫn do app Flask đồng bộ xử lý.
+#
+# Cài thêm: pip install "sqlalchemy[asyncio]" aiosqlite asgiref uvicorn
+# Chạy:     uvicorn asgi:application --host 0.0.0.0 --port 1234
+import math
+import os
+import re
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import request, session
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import selectinload
+
+from app import app
+from inventory import start_sweeper
+from models import User, Product, Category, StockShard
+from retention import start_retention_job
+
+PER_PAGE = 8
+
+engine = create_async_engine(app.config.get(
+    'ASYNC_DATABASE_URI', 'sqlite+aiosqlite:///' + os.path.join(app.instance_path, 'users.db')))
+AsyncSession = async_sessionmaker(engine, expire_on_commit=False)
+wsgi_application = WsgiToAsgi(app)
+
+
+class Page:
+    # Giống Pagination của Flask-SQLAlchemy để dùng lại template index.html
+    def __init__(self, items, page, per_page, total):
+        self.items = items
+        self.page = page
+        self.total = total
+        self.pages = math.ceil(total / per_page) if total else 0
+        self.has_prev = page > 1
+        self.prev_num = page - 1 if self.has_prev else None
+        self.has_next = page < self.pages
+        self.next_num = page + 1 if self.has_next else None
+
+
+def render(template_name, **context):
+    # Không dùng render_template vì context processor inject_user truy vấn DB đồng bộ
+    return app.jinja_env.get_template(template_name).render(**context)
+
+
+async def load_current_user(db_session):
+    if 'user_id' not in session:
+        return None
+    return await db_session.get(User, session['user_id'])
+
+
+async def index():
+    page = max(request.args.get('page', 1, type=int), 1)
+    category_id = request.args.get('category', type=int)
+
+    query = select(Product)
+    count_query = select(func.count(Product.id))
+    if category_id:
+        query = query.where(Product.category_id == category_id)
+        count_query = count_query.where(Product.category_id == category_id)
+
+    async with AsyncSession() as db_session:
+        current_user = await load_current_user(db_session)
+        total = await db_session.scalar(count_query)
+        products = (await db_session.scalars(
+            query.order_by(Product.created_at.desc()).limit(PER_PAGE).offset((page - 1) * PER_PAGE))).all()
+        categories = (await db_session.scalars(select(Category))).all()
+
+    return render('index.html', current_user=current_user, new_products=Page(products, page, PER_PAGE, total),
+                  categories=categories, selected_category=category_id)
+
+
+async def search():
+    query = request.args.get('query', '')
+    async with AsyncSession() as db_session:
+        current_user = await load_current_user(db_session)
+        products = []
+        if query:
+            products = (await db_session.scalars(select(Product).where(Product.name.ilike(f'%{query}%')))).all()
+
+    return render('search_results.html', current_user=current_user, products=products, query=query)
+
+
+async def product_detail(product_id):
+    async with AsyncSession() as db_session:
+        product = await db_session.get(Product, product_id, options=[selectinload(Product.category)])
+        if not product:
+            return None  # Để app Flask trả về trang 404
+        current_user = await load_current_user(db_session)
+        stock = await db_session.scalar(select(func.sum(StockShard.quantity)).where(StockShard.product_id == product_id))
+
+    return render('product_detail.html', current_user=current_user, product=product, stock=stock)
+
+
+ROUTES = [
+    (re.compile(r'^/index$'), index),
+    (re.compile(r'^/search$'), search),
+    (re.compile(r'^/product/(?P<product_id>\d+)$'), product_detail),
+]
+
+
+def match_route(path):
+    for pattern, view in ROUTES:
+        match = pattern.match(path)
+        if match:
+            return view, {key: int(value) for key, value in match.groupdict().items()}
+    return None, None
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Như app.run: trả hàng giữ quá hạn và chạy job lưu trữ đơn hàng trong nền
+                start_sweeper(app)
+                start_retention_job(app)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    view, kwargs = None, None
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        view, kwargs = match_route(scope['path'])
+
+    if view is not None:
+        # Giữ dạng danh sách cặp để không mất header lặp lại. Riêng Cookie (HTTP/2 tách mỗi cookie
+        # một dòng) phải nối bằng "; " thì werkzeug mới đọc được, không phải ", " như header khác.
+        headers = [(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']
+                   if key.lower() != b'cookie']
+        cookies = [value.decode('latin-1') for key, value in scope['headers'] if key.lower() == b'cookie']
+        if cookies:
+            headers.append(('Cookie', '; '.join(cookies)))
+        # Request context chỉ để đọc session cookie, request.args và dùng url_for trong template
+        with app.test_request_context(scope['path'], query_string=scope['query_string'].decode('latin-1'),
+                                      headers=headers):
+            html = await view(**kwargs)
+
+        if html is not None:
+            body = html.encode('utf-8')
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/html; charset=utf-8'),
+                            (b'content-length', str(len(body)).encode())],
+            })
+            await send({'type': 'http.response.body', 'body': body if scope['method'] == 'GET' else b''})
+            return
+
+    await wsgi_application(scope, receive, send)
@@ -0,0 +1,170 @@
+import heapq
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, Product, OrderItem, ArchivedOrderItem
+
+MAX_ENTRIES = 200000  # Giới hạn số khóa để index không chiếm quá nhiều bộ nhớ
+MAX_KEY_LENGTH = 48
+MAX_WORDS = 6  # Số từ đầu tiên của tên/tác giả được dùng làm điểm bắt đầu gợi ý
+MAX_SCAN = 500  # Prefix khớp nhiều khóa hơn thì dùng danh sách top tính sẵn thay vì duyệt
+SHORT_PREFIX = 3  # Độ dài prefix được tính sẵn top khi build
+TOP_N = 20  # Bằng giới hạn limit tối đa của /autocomplete
+MAX_TOP_PREFIXES = 50000  # Giới hạn số prefix được cache top
+DEFAULT_LIMIT = 8
+
+
+def normalize(text):
+    # Chữ thường, bỏ dấu tiếng Việt để "truyen" khớp với "Truyện"
+    text = unicodedata.normalize('NFD', (text or '').lower().replace('đ', 'd'))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.split())
+
+
+def index_keys(name, author):
+    keys = set()
+    for field in (name, author):
+        words = normalize(field).split(' ')
+        # Mỗi vị trí bắt đầu của từ là một khóa, để "potter" cũng khớp "Harry Potter"
+        for i in range(min(len(words), MAX_WORDS)):
+            key = ' '.join(words[i:])[:MAX_KEY_LENGTH]
+            if key:
+                keys.add(key)
+    return keys
+
+
+class PrefixIndex:
+    # Mảng khóa đã sắp xếp + bisect; ids song song lưu trong array('l') cho gọn bộ nhớ.
+    # Prefix khớp quá MAX_SCAN khóa (thường là prefix 1-3 ký tự) có sẵn danh sách top TOP_N theo
+    # doanh số trong self.top, được cập nhật khi thêm/sửa/xóa sản phẩm và khi có đơn hàng.
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.keys = []
+        self.ids = array('l')
+        self.products = {}  # product_id -> (name, author)
+        self.sales = {}  # product_id -> số lượng đã bán
+        self.top = {}  # prefix -> [product_id] xếp theo doanh số giảm dần
+        self.lock = threading.RLock()
+
+    def build(self):
+        # Đọc Product theo luồng (yield_per) thay vì tải hết vào bộ nhớ một lần
+        entries = []
+        products = {}
+        query = db.session.query(Product.id, Product.name, Product.author).yield_per(1000)
+        for product_id, name, author in query:
+            products[product_id] = (name, author)
+            entries.extend((key, product_id) for key in index_keys(name, author))
+
+        entries.sort()
+        if len(entries) > self.max_entries:
+            current_app.logger.warning(
+                f"Autocomplete index full: dropped {len(entries) - self.max_entries} of {len(entries)} keys")
+            entries = entries[:self.max_entries]
+
+        sales = {}
+        for model in (OrderItem, ArchivedOrderItem):
+            rows = db.session.query(model.product_id, func.sum(model.quantity)).group_by(model.product_id)
+            for product_id, quantity in rows:
+                sales[product_id] = sales.get(product_id, 0) + int(quantity)
+
+        with self.lock:
+            self.keys = [key for key, _ in entries]
+            self.ids = array('l', (product_id for _, product_id in entries))
+            self.products = products
+            self.sales = sales
+            self.top = {}
+            # Tính trước top cho các prefix ngắn, là những prefix khớp nhiều khóa nhất
+            for prefix in {key[:n] for key in self.keys for n in range(1, SHORT_PREFIX + 1)}:
+                lo, hi = self.key_range(prefix)
+                if hi - lo > MAX_SCAN:
+                    self.cache_top(prefix, self.rank(lo, hi))
+
+    def rank_key(self, product_id):
+        return (-self.sales.get(product_id, 0), product_id)
+
+    def key_range(self, prefix):
+        return bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + '\U0010ffff')
+
+    def rank(self, lo, hi):
+        return heapq.nsmallest(TOP_N, set(self.ids[lo:hi]), key=self.rank_key)
+
+    def cache_top(self, prefix, ranked):
+        if prefix in self.top or len(self.top) < MAX_TOP_PREFIXES:
+            self.top[prefix] = ranked
+
+    def cached_prefixes(self, product_id):
+        # Các prefix đang có trong self.top mà sản phẩm này khớp
+        prefixes = set()
+        for key in index_keys(*self.products[product_id]):
+            prefixes.update(p for p in (key[:n] for n in range(1, len(key) + 1)) if p in self.top)
+        return prefixes
+
+    def promote(self, product_id):
+        # Đưa sản phẩm vào/lên danh sách top của các prefix nó khớp (sau khi thêm hoặc bán thêm)
+        for prefix in self.cached_prefixes(product_id):
+            ranked = self.top[prefix]
+            if product_id not in ranked:
+                ranked.append(product_id)
+            ranked.sort(key=self.rank_key)
+            del ranked[TOP_N:]
+
+    def add(self, product):
+        with self.lock:
+            self.remove(product.id)
+            self.products[product.id] = (product.name, product.author)
+            for key in index_keys(product.name, product.author):
+                if len(self.keys) >= self.max_entries:
+                    current_app.logger.warning(
+                        f"Autocomplete index full ({self.max_entries} keys): product {product.id} partially indexed")
+                    break
+                i = bisect_left(self.keys, key)
+                self.keys.insert(i, key)
+                self.ids.insert(i, product.id)
+            self.promote(product.id)
+
+    def remove(self, product_id):
+        with self.lock:
+            if product_id not in self.products:
+                return
+            # Danh sách top có sản phẩm này bị bỏ đi, sẽ tính lại khi có truy vấn
+            for prefix in self.cached_prefixes(product_id):
+                if product_id in self.top[prefix]:
+                    del self.top[prefix]
+
+            for key in index_keys(*self.products.pop(product_id)):
+                i = bisect_left(self.keys, key)
+                while i < len(self.keys) and self.keys[i] == key:
+                    if self.ids[i] == product_id:
+                        del self.keys[i]
+                        del self.ids[i]
+                        break
+                    i += 1
+
+    def record_sale(self, product_id, quantity):
+        with self.lock:
+            self.sales[product_id] = self.sales.get(product_id, 0) + quantity
+            if product_id in self.products:
+                self.promote(product_id)
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        prefix = normalize(query)[:MAX_KEY_LENGTH]
+        if not prefix:
+            return []
+
+        with self.lock:
+            ranked = self.top.get(prefix)
+            if ranked is None:
+                lo, hi = self.key_range(prefix)
+                ranked = self.rank(lo, hi)
+                if hi - lo > MAX_SCAN:
+                    self.cache_top(prefix, ranked)
+
+            return [dict(id=pid, name=self.products[pid][0], author=self.products[pid][1]) for pid in ranked[:limit]]
+
+
+search_index = PrefixIndex()
@@ -0,0 +1,118 @@
+# Benchmark tranh chấp tồn kho: nhiều thread cùng mua một sản phẩm trong đợt flash sale.
+# Chạy: python bench_inventory.py [--threads 16] [--stock 500] [--shards 1 8]
+# Kiểm tra số đơn tạo ra bằng đúng số hàng ban đầu (không bán quá) và kho không âm.
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from flask import Flask
+from sqlalchemy import event, func
+from sqlalchemy.exc import OperationalError
+
+import inventory
+from inventory import OutOfStock, set_stock, take_stock
+from models import db, User, Category, Product, Order, OrderItem, StockShard
+
+
+def create_app(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30, 'check_same_thread': False}}
+    db.init_app(app)
+
+    with app.app_context():
+        @event.listens_for(db.engine, 'connect')
+        def set_wal(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA journal_mode=WAL')
+
+        db.create_all()
+    return app
+
+
+def run(app, threads, stock, shards):
+    inventory.STOCK_SHARDS = shards
+    with app.app_context():
+        db.session.query(OrderItem).delete()
+        db.session.query(Order).delete()
+        user = User.query.first()
+        product = Product.query.first()
+        set_stock(product.id, stock, shards=shards)
+        db.session.commit()
+        user_id, product_id, price = user.id, product.id, product.price
+
+    counts = {'orders': 0, 'sold_out': 0, 'retries': 0}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(threads)
+
+    def worker():
+        start_barrier.wait()
+        with app.app_context():
+            while True:
+                try:
+                    # Giống buy_product: trừ kho và tạo đơn trong cùng một transaction
+                    take_stock(product_id, 1)
+                    order = Order(user_id=user_id, total_price=price)
+                    order.items.append(OrderItem(product_id=product_id, quantity=1, unit_price=price))
+                    db.session.add(order)
+                    db.session.commit()
+                    with lock:
+                        counts['orders'] += 1
+                except OutOfStock:
+                    db.session.rollback()
+                    with lock:
+                        counts['sold_out'] += 1
+                    return
+                except OperationalError:
+                    db.session.rollback()
+                    with lock:
+                        counts['retries'] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        orders = Order.query.count()
+        remaining = db.session.query(func.sum(StockShard.quantity)).filter_by(product_id=product_id).scalar()
+        lowest = db.session.query(func.min(StockShard.quantity)).filter_by(product_id=product_id).scalar()
+        db.session.remove()
+
+    oversold = orders - stock
+    print(f'shards={shards:<3} threads={threads:<3} orders={orders:<6} remaining={remaining:<4} '
+          f'min_shard={lowest:<3} retries={counts["retries"]:<5} '
+          f'{orders / elapsed:8.1f} orders/s  oversold={oversold}')
+    assert oversold == 0 and remaining == 0 and lowest >= 0, 'oversell detected'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--stock', type=int, default=500)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(os.path.join(tmp, 'bench.db'))
+        with app.app_context():
+            category = Category(name='bench')
+            user = User(username='bench', email='bench@example.com', password_hash='-')
+            db.session.add_all([category, user])
+            db.session.flush()
+            db.session.add(Product(name='Flash sale', price=1.0, author='bench', category_id=category.id))
+            db.session.commit()
+
+        for shards in args.shards:
+            run(app, args.threads, args.stock, shards)
+
+        with app.app_context():
+            db.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# So sánh throughput khi nhiều kết nối đồng thời giữa hai chế độ:
+#   sync: app Flask chạy bằng server WSGI đa luồng (như app.run)
+#   asgi: asgi.py chạy bằng uvicorn (trang catalog async trên aiosqlite)
+# Chạy: python bench_serving.py [--connections 10 50 200] [--requests 1000] [--trickle 0.05]
+# --trickle mô phỏng client chậm: gửi request thành hai phần, nghỉ giữa hai lần gửi.
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+PATHS = ['/index', '/index?category=1', '/search?query=a', '/product/1']
+
+SERVERS = {
+    'sync': [sys.executable, '-c', 'from app import app; app.run(port={port}, threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', '{port}', '--log-level', 'warning'],
+}
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'server on port {port} did not start')
+
+
+async def fetch(port, path, trickle):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    head = f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n'.encode()
+    writer.write(head)
+    if trickle:
+        await writer.drain()
+        await asyncio.sleep(trickle)
+    writer.write(b'Connection: close\r\n\r\n')
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response.split(b' ', 2)[1] == b'200'
+
+
+async def load(port, connections, total, trickle):
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def client():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                ok = await fetch(port, PATHS[i % len(PATHS)], trickle)
+            except OSError:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(connections)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    return total / elapsed, p50, p95, errors
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--trickle', type=float, default=0.05)
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    for mode, command in SERVERS.items():
+        process = subprocess.Popen([part.format(port=args.port) for part in command], cwd=root,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await wait_for_port(args.port)
+            await load(args.port, 4, 40, 0)  # Khởi động trước (warm-up)
+            for connections in args.connections:
+                rps, p50, p95, errors = await load(args.port, connections, args.requests, args.trickle)
+                print(f'{mode:<5} connections={connections:<4} {rps:8.1f} req/s  '
+                      f'p50={p50:7.1f} ms  p95={p95:7.1f} ms  errors={errors}')
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy.dialects.sqlite import insert
+
+from models import db, Product, Cart, CartItem
+from inventory import OutOfStock, reserve, stock_levels
+
+MAX_QUANTITY = 100000
+MAX_GUEST_ITEMS = 50  # Giỏ hàng khách lưu trong cookie session nên giới hạn số dòng
+CART_OPS = ('add', 'update', 'remove')
+
+GuestCartItem = namedtuple('GuestCartItem', ['product', 'quantity'])
+GuestCart = namedtuple('GuestCart', ['items'])
+
+
+class CartError(Exception):
+    pass
+
+
+def parse_ops(raw_ops):
+    if not isinstance(raw_ops, list) or not raw_ops:
+        raise CartError('Danh sách thao tác không hợp lệ.')
+
+    ops = []
+    for raw in raw_ops:
+        if not isinstance(raw, dict) or raw.get('op') not in CART_OPS:
+            raise CartError('Thao tác giỏ hàng không hợp lệ.')
+        try:
+            product_id = int(raw.get('product_id'))
+            quantity = int(raw.get('quantity', 1))
+        except (TypeError, ValueError):
+            raise CartError('Mã sản phẩm hoặc số lượng không hợp lệ.')
+
+        if raw['op'] != 'remove':
+            if quantity <= 0:
+                raise CartError('Số lượng sản phẩm phải lớn hơn 0.')
+            if quantity > MAX_QUANTITY:
+                raise CartError('Số lượng không thể lớn hơn 100.000.')
+        ops.append((raw['op'], product_id, quantity))
+    return ops
+
+
+def apply_ops(quantities, ops):
+    # quantities: {product_id: quantity}, được sửa trực tiếp
+    for op, product_id, quantity in ops:
+        if op == 'add':
+            quantities[product_id] = min(quantities.get(product_id, 0) + quantity, MAX_QUANTITY)
+        elif op == 'update':
+            quantities[product_id] = quantity
+        else:
+            quantities.pop(product_id, None)
+    return quantities
+
+
+def check_products_exist(product_ids):
+    if not product_ids:
+        return
+    found = {pid for (pid,) in db.session.query(Product.id).filter(Product.id.in_(product_ids))}
+    if found != set(product_ids):
+        raise CartError('Không tìm thấy sản phẩm.')
+
+
+def get_or_create_cart(user):
+    cart = Cart.query.filter_by(user_id=user.id).first()
+    if not cart:
+        cart = Cart(user_id=user.id)
+        db.session.add(cart)
+        db.session.flush()
+    return cart
+
+
+def apply_user_ops(user, ops):
+    # Áp dụng toàn bộ thao tác trong một transaction, upsert theo (cart_id, product_id)
+    cart = get_or_create_cart(user)
+    items = {item.product_id: item for item in CartItem.query.filter_by(cart_id=cart.id)}
+    quantities = apply_ops({pid: item.quantity for pid, item in items.items()}, ops)
+    check_products_exist([pid for pid in quantities if pid not in items])
+
+    # Giữ thêm / trả lại hàng theo phần chênh lệch số lượng
+    old_quantities = {pid: item.quantity for pid, item in items.items()}
+    for product_id in set(old_quantities) | set(quantities):
+        delta = quantities.get(product_id, 0) - old_quantities.get(product_id, 0)
+        if delta:
+            try:
+                reserve(cart.id, product_id, delta)
+            except OutOfStock:
+                raise CartError('Sản phẩm không còn đủ hàng.')
+
+    for product_id, item in items.items():
+        if product_id not in quantities:
+            db.session.delete(item)
+        else:
+            item.quantity = quantities[product_id]
+
+    new_rows = [dict(cart_id=cart.id, product_id=pid, quantity=qty)
+                for pid, qty in quantities.items() if pid not in items]
+    if new_rows:
+        # Request khác (tab khác, form submit) có thể vừa thêm cùng sản phẩm: ghi đè số lượng thay vì thêm dòng mới
+        statement = insert(CartItem).values(new_rows)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['cart_id', 'product_id'],
+            set_={'quantity': statement.excluded.quantity},
+        ))
+
+    cart.updated_at = datetime.utcnow()
+    db.session.commit()
+    return cart
+
+
+def guest_quantities(session):
+    return {int(pid): qty for pid, qty in session.get('guest_cart', {}).items()}
+
+
+def cap_to_stock(quantities):
+    # Giỏ hàng khách không giữ hàng, nên không cho số lượng vượt quá tồn kho hiện có
+    levels = stock_levels(list(quantities))
+    return {pid: min(qty, levels.get(pid, qty)) for pid, qty in quantities.items()}
+
+
+def apply_guest_ops(session, ops):
+    quantities = apply_ops(guest_quantities(session), ops)
+    if len(quantities) > MAX_GUEST_ITEMS:
+        raise CartError('Giỏ hàng có quá nhiều sản phẩm, vui lòng đăng nhập.')
+    check_products_exist(list(quantities))
+
+    quantities = cap_to_stock(quantities)
+    changed = {product_id for _, product_id, _ in ops}
+    if any(quantities[pid] == 0 for pid in changed if pid in quantities):
+        raise CartError('Sản phẩm đã hết hàng.')
+    quantities = {pid: qty for pid, qty in quantities.items() if qty > 0}
+
+    session['guest_cart'] = {str(pid): qty for pid, qty in quantities.items()}
+    return quantities
+
+
+def guest_cart(session):
+    quantities = cap_to_stock(guest_quantities(session))
+    products = Product.query.filter(Product.id.in_(quantities)).all() if quantities else []
+    return GuestCart(items=[GuestCartItem(product, quantities[product.id])
+                            for product in products if quantities[product.id] > 0])
+
+
+def merge_guest_cart(session, user):
+    # Gộp giỏ hàng khách vào bảng Cart khi đăng nhập, qua apply_user_ops để giữ hàng như khi
+    # người dùng tự thêm. Gộp từng sản phẩm một để một sản phẩm hết hàng không làm mất cả giỏ.
+    # Trả về [(tên sản phẩm, số lượng trong giỏ khách, số lượng đã gộp)] cho các sản phẩm bị giảm/bỏ.
+    quantities = guest_quantities(session)
+    names = dict(db.session.query(Product.id, Product.name).filter(Product.id.in_(quantities))) if quantities else {}
+
+    adjusted = []
+    for product_id, requested in quantities.items():
+        if product_id not in names:
+            continue  # Sản phẩm đã bị xóa
+        quantity = cap_to_stock({product_id: requested})[product_id]
+        if quantity > 0:
+            try:
+                apply_user_ops(user, [('add', product_id, quantity)])
+            except CartError:
+                db.session.rollback()  # Request khác vừa mua hết hàng
+                quantity = 0
+        if quantity < requested:
+            adjusted.append((names[product_id], requested, quantity))
+
+    # Chỉ xóa giỏ hàng khách sau khi đã gộp xong
+    session.pop('guest_cart', None)
+    return adjusted
+
+
+def cart_summary(items):
+    rows = [dict(product_id=item.product.id, quantity=item.quantity, unit_price=item.product.price,
+                 total_price=item.product.price * item.quantity) for item in items]
+    return dict(items=rows, total_price=sum(row['total_price'] for row in rows))
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from flask import send_from_directory
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow không có thì chỉ lưu ảnh gốc, không tạo thumbnail
+    Image = None
+
+THUMBNAIL_WIDTHS = (160, 320, 640)
+ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+FORMAT_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}  # Định dạng Pillow -> đuôi file lưu
+CACHE_MAX_AGE = 365 * 24 * 3600  # Tên file theo nội dung nên có thể cache 1 năm
+URL_PREFIX = '/media/products/'
+
+
+class ImageStore:
+    def __init__(self, widths=THUMBNAIL_WIDTHS, max_workers=2):
+        self.widths = tuple(sorted(widths))
+        self.max_workers = max_workers
+        self.root = None
+        self.executor = None
+        self.logger = None
+        # name -> [(width, filename)] gồm thumbnail đã tạo xong và ảnh gốc, để không phải stat file mỗi lần render
+        self.variants = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.root = app.config.setdefault('IMAGE_STORE_ROOT', os.path.join(app.instance_path, 'images'))
+        os.makedirs(self.root, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='thumbnail')
+        self.logger = app.logger
+
+        app.add_url_rule(URL_PREFIX + '<path:filename>', 'product_image', self.serve)
+        app.jinja_env.globals.update(image_src=self.src, image_srcset=self.srcset)
+
+    def serve(self, filename):
+        response = send_from_directory(self.root, filename, max_age=CACHE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    @staticmethod
+    def allowed_file(filename):
+        return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+    @staticmethod
+    def is_local(url):
+        return bool(url) and url.startswith(URL_PREFIX)
+
+    def thumbnail_name(self, name, width):
+        key, ext = name.rsplit('.', 1)
+        return f'{key}-{width}w.{ext}'
+
+    @staticmethod
+    def detect_extension(data, filename):
+        # Có Pillow thì kiểm tra nội dung thật và lấy đuôi theo định dạng phát hiện được,
+        # không tin tên file client gửi lên. Không phải ảnh hợp lệ thì raise ValueError.
+        if Image is None:
+            ext = filename.rsplit('.', 1)[1].lower()
+            return 'jpg' if ext == 'jpeg' else ext
+        try:
+            with Image.open(BytesIO(data)) as image:
+                image_format = image.format
+                image.verify()
+        except Exception:
+            raise ValueError(filename)
+        if image_format not in FORMAT_EXTENSIONS:
+            raise ValueError(filename)
+        return FORMAT_EXTENSIONS[image_format]
+
+    def save(self, data, filename):
+        ext = self.detect_extension(data, filename)
+        name = f'{hashlib.sha256(data).hexdigest()[:32]}.{ext}'
+        path = os.path.join(self.root, name)
+
+        # Cùng nội dung thì cùng tên file, không cần ghi lại
+        if not os.path.exists(path):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        if Image is not None:
+            with self.lock:
+                self.pending.add(name)
+                self.variants.pop(name, None)
+            self.executor.submit(self.generate_thumbnails, name)
+        return URL_PREFIX + name
+
+    def save_upload(self, file_storage):
+        if not file_storage or not file_storage.filename:
+            return None
+        if not self.allowed_file(file_storage.filename):
+            raise ValueError(file_storage.filename)
+        return self.save(file_storage.read(), file_storage.filename)
+
+    def generate_thumbnails(self, name):
+        try:
+            with Image.open(os.path.join(self.root, name)) as original:
+                original.load()
+                for width in self.widths:
+                    if width >= original.width:
+                        break
+                    path = os.path.join(self.root, self.thumbnail_name(name, width))
+                    if os.path.exists(path):
+                        continue
+
+                    height = max(1, round(original.height * width / original.width))
+                    thumbnail = original.resize((width, height), Image.LANCZOS)
+                    if name.endswith('.jpg') and thumbnail.mode not in ('RGB', 'L'):
+                        thumbnail = thumbnail.convert('RGB')
+
+                    tmp_path = path + '.tmp'
+                    thumbnail.save(tmp_path, format=original.format, optimize=True)
+                    os.replace(tmp_path, path)
+        except Exception as e:
+            self.logger.error(f"Error while generating thumbnails for {name}: {str(e)}")
+
+        variants = self.scan_variants(name)
+        with self.lock:
+            self.pending.discard(name)
+            self.variants[name] = variants
+
+    def scan_variants(self, name):
+        # Đọc chiều rộng ảnh gốc (chỉ đọc header) và các thumbnail đã có trên đĩa
+        if Image is None:
+            return []
+        try:
+            with Image.open(os.path.join(self.root, name)) as original:
+                original_width = original.width
+        except Exception:
+            return []
+
+        variants = [(w, self.thumbnail_name(name, w)) for w in self.widths
+                    if w < original_width and os.path.exists(os.path.join(self.root, self.thumbnail_name(name, w)))]
+        variants.append((original_width, name))
+        return variants
+
+    def get_variants(self, name):
+        with self.lock:
+            if name in self.variants:
+                return self.variants[name]
+            if name in self.pending:
+                return []  # Đang tạo thumbnail, tạm dùng ảnh gốc qua src
+        # Ảnh lưu từ lần chạy trước: quét đĩa một lần rồi cache lại
+        variants = self.scan_variants(name)
+        with self.lock:
+            if name not in self.pending:
+                self.variants[name] = variants
+        return variants
+
+    def src(self, url, width=None):
+        # Ảnh ngoài (URL tự do) giữ nguyên; ảnh local thì lấy bản nhỏ nhất đủ rộng
+        if not self.is_local(url) or width is None:
+            return url or ''
+        for w, filename in self.get_variants(url[len(URL_PREFIX):]):
+            if w >= width:
+                return URL_PREFIX + filename
+        return url
+
+    def srcset(self, url):
+        # Luôn có ảnh gốc với chiều rộng thật, để màn hình lớn không phải phóng to thumbnail 640w
+        if not self.is_local(url):
+            return ''
+        return ', '.join(f'{URL_PREFIX}{filename} {w}w' for w, filename in self.get_variants(url[len(URL_PREFIX):]))
+
+    def import_file(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        return self.save(data, os.path.basename(path))
+
+
+image_store = ImageStore()
@@ -0,0 +1,205 @@
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, func
+
+from models import db, StockShard, StockReservation
+
+STOCK_SHARDS = 8
+RESERVATION_TTL = timedelta(minutes=15)
+SWEEP_INTERVAL = 60  # giây
+SWEEP_BATCH_SIZE = 500
+MAX_TAKE_ATTEMPTS = 5
+
+# Sản phẩm không có dòng StockShard nào là sản phẩm không quản lý tồn kho (bán không giới hạn)
+
+
+class OutOfStock(Exception):
+    pass
+
+
+def parse_stock(value):
+    # Giá trị từ form admin: để trống = không quản lý tồn kho, còn lại phải là số nguyên >= 0
+    value = (value or '').strip()
+    if not value:
+        return None
+    stock = int(value)
+    if stock < 0:
+        raise ValueError(value)
+    return stock
+
+
+def set_stock(product_id, total, shards=STOCK_SHARDS):
+    db.session.execute(delete(StockShard).where(StockShard.product_id == product_id))
+    if total is None:
+        return
+    base, extra = divmod(max(int(total), 0), shards)
+    db.session.add_all([StockShard(product_id=product_id, shard=i, quantity=base + (1 if i < extra else 0))
+                        for i in range(shards)])
+
+
+def available_stock(product_id):
+    return stock_levels([product_id]).get(product_id)
+
+
+def stock_levels(product_ids):
+    # Trả về {product_id: số lượng còn}; sản phẩm không quản lý tồn kho không có trong dict
+    if not product_ids:
+        return {}
+    rows = db.session.execute(
+        select(StockShard.product_id, func.sum(StockShard.quantity))
+        .where(StockShard.product_id.in_(product_ids))
+        .group_by(StockShard.product_id)
+    )
+    return {product_id: int(total) for product_id, total in rows}
+
+
+def take_stock(product_id, quantity):
+    # Trừ kho bằng UPDATE có điều kiện "quantity >= n" trên từng shard nên không bao giờ âm,
+    # kể cả khi nhiều request cùng mua. Caller chịu trách nhiệm commit cùng với đơn hàng.
+    # Trả về False nếu sản phẩm không quản lý tồn kho.
+    if quantity <= 0:
+        return True
+
+    for _ in range(MAX_TAKE_ATTEMPTS):
+        rows = db.session.execute(
+            select(StockShard.shard, StockShard.quantity).where(StockShard.product_id == product_id)
+        ).all()
+        if not rows:
+            return False
+        if sum(q for _, q in rows) < quantity:
+            raise OutOfStock(product_id)
+
+        # Bắt đầu từ shard ngẫu nhiên để các request không dồn vào cùng một dòng,
+        # ưu tiên shard đủ hàng một mình
+        random.shuffle(rows)
+        rows.sort(key=lambda row: row[1] < quantity)
+
+        taken = []
+        remaining = quantity
+        for shard, shard_quantity in rows:
+            n = min(shard_quantity, remaining)
+            if n <= 0:
+                continue
+            result = db.session.execute(
+                update(StockShard)
+                .where(StockShard.product_id == product_id, StockShard.shard == shard, StockShard.quantity >= n)
+                .values(quantity=StockShard.quantity - n)
+            )
+            if result.rowcount:
+                taken.append((shard, n))
+                remaining -= n
+                if remaining == 0:
+                    return True
+
+        # Shard đã bị request khác lấy mất: trả lại phần đã lấy rồi đọc lại
+        for shard, n in taken:
+            _add_to_shard(product_id, shard, n)
+
+    raise OutOfStock(product_id)
+
+
+def adjust_stock(product_id, delta):
+    # Cộng/trừ tồn kho theo chênh lệch, không ghi đè số hàng đã bán trong lúc admin sửa form
+    if delta > 0:
+        release_stock(product_id, delta)
+    elif delta < 0:
+        take_stock(product_id, -delta)
+
+
+def release_stock(product_id, quantity):
+    if quantity > 0:
+        _add_to_shard(product_id, random.randrange(STOCK_SHARDS), quantity)
+
+
+def _add_to_shard(product_id, shard, quantity):
+    result = db.session.execute(
+        update(StockShard)
+        .where(StockShard.product_id == product_id, StockShard.shard == shard)
+        .values(quantity=StockShard.quantity + quantity)
+    )
+    if not result.rowcount:
+        # Số shard đã thay đổi (admin đặt lại tồn kho): trả vào shard 0
+        db.session.execute(
+            update(StockShard)
+            .where(StockShard.product_id == product_id, StockShard.shard == 0)
+            .values(quantity=StockShard.quantity + quantity)
+        )
+
+
+def reserve(cart_id, product_id, delta):
+    # Giữ hàng khi thêm vào giỏ (delta > 0) hoặc trả lại khi giảm số lượng (delta < 0)
+    reservation = StockReservation.query.filter_by(cart_id=cart_id, product_id=product_id).first()
+
+    if delta > 0:
+        if not take_stock(product_id, delta):
+            return
+        if reservation:
+            reservation.quantity += delta
+        else:
+            reservation = StockReservation(cart_id=cart_id, product_id=product_id, quantity=delta)
+            db.session.add(reservation)
+        reservation.expires_at = datetime.utcnow() + RESERVATION_TTL
+    elif delta < 0 and reservation:
+        released = min(-delta, reservation.quantity)
+        release_stock(product_id, released)
+        reservation.quantity -= released
+        if reservation.quantity == 0:
+            db.session.delete(reservation)
+
+
+def consume(cart_id, product_id, quantity):
+    # Dùng hàng đã giữ cho đơn hàng, phần thiếu thì trừ thẳng vào kho
+    reservation = None
+    if cart_id is not None:
+        reservation = StockReservation.query.filter_by(cart_id=cart_id, product_id=product_id).first()
+
+    covered = 0
+    if reservation:
+        covered = min(reservation.quantity, quantity)
+        release_stock(product_id, reservation.quantity - covered)
+        db.session.delete(reservation)
+    take_stock(product_id, quantity - covered)
+
+
+def release_cart(cart_id):
+    for reservation in StockReservation.query.filter_by(cart_id=cart_id).all():
+        release_stock(reservation.product_id, reservation.quantity)
+        db.session.delete(reservation)
+
+
+def forget_product(product_id):
+    db.session.execute(delete(StockReservation).where(StockReservation.product_id == product_id))
+    db.session.execute(delete(StockShard).where(StockShard.product_id == product_id))
+
+
+def sweep_expired_reservations(batch_size=SWEEP_BATCH_SIZE):
+    expired = (StockReservation.query
+               .filter(StockReservation.expires_at <= datetime.utcnow())
+               .order_by(StockReservation.expires_at)
+               .limit(batch_size)
+               .all())
+    for reservation in expired:
+        release_stock(reservation.product_id, reservation.quantity)
+        db.session.delete(reservation)
+    db.session.commit()
+    return len(expired)
+
+
+def start_sweeper(app, interval=SWEEP_INTERVAL):
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    while sweep_expired_reservations() == SWEEP_BATCH_SIZE:
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Error while sweeping reservations: {str(e)}")
+
+    thread = threading.Thread(target=run, name='reservation-sweeper', daemon=True)
+    thread.start()
+    return thread
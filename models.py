@@ -1,5 +1,6 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
 from werkzeug.security import generate_password_hash, check_password_hash
 
 db = SQLAlchemy()
@@ -17,6 +18,7 @@ class User(db.Model):
     feedbacks = db.relationship('Feedback', back_populates='user', cascade='all, delete-orphan')
     carts = db.relationship('Cart', backref='user', lazy=True)
     orders = db.relationship('Order', back_populates='user', cascade='all, delete-orphan')
+    archived_orders = db.relationship('ArchivedOrder', back_populates='user', cascade='all, delete-orphan')
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -52,6 +54,7 @@ class Cart(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # Lần cuối giỏ hàng thay đổi
 
     items = db.relationship('CartItem', backref='cart', lazy=True, cascade='all, delete-orphan')
 
@@ -67,6 +70,9 @@ class CartItem(db.Model):
 
     product = db.relationship('Product', backref='cart_items')
 
+    # Mỗi sản phẩm chỉ có một dòng trong giỏ, để upsert theo (cart_id, product_id)
+    __table_args__ = (db.UniqueConstraint('cart_id', 'product_id', name='uq_cart_item_cart_product'),)
+
     def __repr__(self):
         return f'<CartItem {self.id}>'
 
@@ -95,6 +101,10 @@ class Order(db.Model):
     user = db.relationship('User', back_populates='orders')
     items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
 
+    @property
+    def number(self):
+        return self.id
+
     def __repr__(self):
         return f'<Order {self.id}>'
 
@@ -110,3 +120,110 @@ class OrderItem(db.Model):
 
     def __repr__(self):
         return f'<OrderItem {self.id}>'
+
+
+class StockShard(db.Model):
+    # Tồn kho của một sản phẩm được chia thành nhiều dòng (shard) để tránh tranh chấp một dòng duy nhất
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<StockShard {self.product_id}:{self.shard}>'
+
+
+class StockReservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    cart_id = db.Column(db.Integer, db.ForeignKey('cart.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (db.UniqueConstraint('cart_id', 'product_id'),)
+
+    def __repr__(self):
+        return f'<StockReservation {self.id}>'
+
+
+# Đơn hàng đã hoàn tất/bị hủy lâu ngày được chuyển sang các bảng lưu trữ này
+class ArchivedOrder(db.Model):
+    # id riêng của bảng lưu trữ: SQLite có thể cấp lại id của bảng order sau khi đơn bị xóa,
+    # nên id gốc chỉ lưu ở original_id (không unique)
+    id = db.Column(db.Integer, primary_key=True)
+    original_id = db.Column(db.Integer, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    total_price = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime)
+    status = db.Column(db.String(50))
+    payment_method = db.Column(db.String(50))
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    user = db.relationship('User', back_populates='archived_orders')
+    items = db.relationship('ArchivedOrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    @property
+    def number(self):
+        return self.original_id
+
+    def __repr__(self):
+        return f'<ArchivedOrder {self.id}>'
+
+
+class ArchivedOrderItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)  # Không dùng lại id của order_item, lý do như ArchivedOrder
+    order_id = db.Column(db.Integer, db.ForeignKey('archived_order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+
+    product = db.relationship('Product')
+
+    def __repr__(self):
+        return f'<ArchivedOrderItem {self.id}>'
+
+
+# Cột thêm vào bảng đã có sẵn; db.create_all() không tự thêm cột cho bảng cũ
+ADDED_COLUMNS = {
+    'cart': {'updated_at': 'DATETIME'},
+}
+
+# Ràng buộc unique thêm vào bảng đã có sẵn: tên index -> (bảng, các cột)
+ADDED_UNIQUE_INDEXES = {
+    'uq_cart_item_cart_product': ('cart_item', ('cart_id', 'product_id')),
+}
+
+
+def upgrade_schema():
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {column['name'] for column in inspector.get_columns(table)}
+            for name, column_type in columns.items():
+                if name not in existing:
+                    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}'))
+
+        for index_name, (table, columns) in ADDED_UNIQUE_INDEXES.items():
+            unique_sets = [tuple(c['column_names']) for c in inspector.get_unique_constraints(table)]
+            unique_sets += [tuple(i['column_names']) for i in inspector.get_indexes(table) if i['unique']]
+            if columns in unique_sets:
+                continue
+            if table == 'cart_item':
+                merge_duplicate_cart_items(conn)
+            conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table} ({", ".join(columns)})'))
+
+
+def merge_duplicate_cart_items(conn):
+    # Dữ liệu cũ có thể có nhiều dòng cùng (cart_id, product_id): cộng dồn vào dòng có id nhỏ nhất
+    conn.execute(text('''
+        UPDATE cart_item SET quantity = (
+            SELECT SUM(other.quantity) FROM cart_item AS other
+            WHERE other.cart_id = cart_item.cart_id AND other.product_id = cart_item.product_id
+        )
+        WHERE id IN (SELECT MIN(id) FROM cart_item GROUP BY cart_id, product_id HAVING COUNT(*) > 1)
+    '''))
+    conn.execute(text('''
+        DELETE FROM cart_item
+        WHERE id NOT IN (SELECT MIN(id) FROM cart_item GROUP BY cart_id, product_id)
+    '''))
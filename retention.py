@@ -0,0 +1,130 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, delete, func, text
+
+from models import db, Order, OrderItem, Cart, CartItem, ArchivedOrder, ArchivedOrderItem
+from inventory import release_cart
+
+ARCHIVE_STATUSES = ('đang chờ hàng vận chuyển', 'đơn đã bị hủy')  # Đơn đã duyệt hoặc đã hủy
+ORDER_RETENTION_MONTHS = 6
+CART_RETENTION_DAYS = 30
+BATCH_SIZE = 500
+INCREMENTAL_VACUUM_PAGES = 2000
+RETENTION_INTERVAL = 24 * 3600  # giây
+
+ORDER_COLUMNS = ('user_id', 'total_price', 'created_at', 'status', 'payment_method')
+ORDER_ITEM_COLUMNS = ('product_id', 'quantity', 'unit_price')
+
+
+def archive_orders(months=ORDER_RETENTION_MONTHS, batch_size=BATCH_SIZE):
+    # Chuyển đơn hàng cũ sang bảng lưu trữ, mỗi lô một transaction để không khóa DB lâu
+    cutoff = datetime.utcnow() - timedelta(days=30 * months)
+    archived = 0
+
+    while True:
+        ids = db.session.execute(
+            select(Order.id)
+            .where(Order.status.in_(ARCHIVE_STATUSES), Order.created_at < cutoff)
+            .order_by(Order.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+
+        # Bảng lưu trữ có id riêng; id gốc giữ ở original_id. Chỉ nối với các dòng vừa chèn
+        # (id > last_id) vì original_id có thể trùng với đơn đã lưu trữ trước đó.
+        last_id = db.session.query(func.max(ArchivedOrder.id)).scalar() or 0
+        db.session.execute(insert(ArchivedOrder).from_select(
+            ('original_id',) + ORDER_COLUMNS,
+            select(Order.id, *[getattr(Order, c) for c in ORDER_COLUMNS]).where(Order.id.in_(ids)).order_by(Order.id)))
+        db.session.execute(insert(ArchivedOrderItem).from_select(
+            ('order_id',) + ORDER_ITEM_COLUMNS,
+            select(ArchivedOrder.id, *[getattr(OrderItem, c) for c in ORDER_ITEM_COLUMNS])
+            .join(ArchivedOrder, ArchivedOrder.original_id == OrderItem.order_id)
+            .where(OrderItem.order_id.in_(ids), ArchivedOrder.id > last_id)))
+        db.session.execute(delete(OrderItem).where(OrderItem.order_id.in_(ids)))
+        db.session.execute(delete(Order).where(Order.id.in_(ids)))
+        db.session.commit()
+        archived += len(ids)
+
+    return archived
+
+
+def purge_abandoned_carts(days=CART_RETENTION_DAYS, batch_size=BATCH_SIZE):
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    purged = 0
+
+    while True:
+        ids = db.session.execute(
+            select(Cart.id)
+            .where(func.coalesce(Cart.updated_at, Cart.created_at) < cutoff)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+
+        for cart_id in ids:
+            release_cart(cart_id)  # Trả lại hàng còn giữ (nếu sweeper chưa kịp trả)
+        db.session.execute(delete(CartItem).where(CartItem.cart_id.in_(ids)))
+        db.session.execute(delete(Cart).where(Cart.id.in_(ids)))
+        db.session.commit()
+        purged += len(ids)
+
+    return purged
+
+
+def compact_database(pages=INCREMENTAL_VACUUM_PAGES):
+    if db.engine.dialect.name != 'sqlite':
+        return
+
+    # VACUUM/PRAGMA không chạy được trong transaction nên dùng kết nối autocommit
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+            # Chuyển sang chế độ incremental một lần duy nhất (cần VACUUM toàn bộ)
+            conn.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+            conn.execute(text('VACUUM'))
+        conn.execute(text(f'PRAGMA incremental_vacuum({int(pages)})'))
+        conn.execute(text('ANALYZE'))
+
+
+def run_retention(app):
+    archived = archive_orders(app.config.get('ORDER_RETENTION_MONTHS', ORDER_RETENTION_MONTHS))
+    purged = purge_abandoned_carts(app.config.get('CART_RETENTION_DAYS', CART_RETENTION_DAYS))
+    compact_database()
+    return archived, purged
+
+
+def start_retention_job(app, interval=RETENTION_INTERVAL):
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    archived, purged = run_retention(app)
+                    app.logger.info(f"Retention: archived {archived} orders, purged {purged} carts")
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"Error while running retention job: {str(e)}")
+
+    thread = threading.Thread(target=run, name='retention-job', daemon=True)
+    thread.start()
+    return thread
+
+
+def orders_for_user(user_id, include_archived=False):
+    # Đơn hàng đang hoạt động, kèm đơn đã lưu trữ khi người dùng yêu cầu
+    orders = Order.query.filter_by(user_id=user_id).all()
+    if include_archived:
+        orders += ArchivedOrder.query.filter_by(user_id=user_id).all()
+        orders.sort(key=lambda order: order.created_at or datetime.min, reverse=True)
+    return orders
+
+
+def all_orders(include_archived=False):
+    orders = Order.query.all()
+    if include_archived:
+        orders += ArchivedOrder.query.all()
+        orders.sort(key=lambda order: order.created_at or datetime.min, reverse=True)
+    return orders